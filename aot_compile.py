@@ -0,0 +1,21 @@
+"""
+Compiles the graph evaluation kernels of main.py ahead of time into the `succinct_kernel` extension module.
+main.py imports the kernels from it when present, so the first fill_nodes call only loads a shared
+library instead of paying for Numba's JIT compilation. Rerun it whenever the kernels change:
+
+    python aot_compile.py
+"""
+
+import os
+
+from numba.pycc import CC
+
+import main
+
+cc = CC("succinct_kernel")
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+cc.export("eval_rows", main.EVAL_SIGNATURE)(main._eval_rows)
+cc.export("check_rows", main.CHECK_SIGNATURE)(main._check_rows)
+
+if __name__ == "__main__":
+    cc.compile()
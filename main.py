@@ -4,20 +4,141 @@ By Xavier D'Mello
 April 24, 2024
 """
 
+import ast
+import bisect
 import math
+from array import array
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional, fill_nodes falls back to the Python loop without it
+    njit = None
 
 # Set to True to print all logs as they are created
 DEBUG = True
 
+# Initial number of rows allocated for the graph arrays, doubled whenever they fill up
+INITIAL_CAPACITY = 1024
+
+# Graphs with at least this many nodes are evaluated with the jitted int64 kernel (if Numba is installed)
+JIT_MIN_NODES = 256
+
+# Graphs whose Kahn layers hold at least this many rows on average are evaluated a layer at a time with NumPy
+LAYER_MIN_WIDTH = 32
+
+# Constraints are checked with NumPy in blocks of this many, so a failing check can stop early
+CHECK_BLOCK_SIZE = 4096
+
+# Opcodes for the rows of the graph arrays
+OP_INPUT = 0
+OP_CONST = 1
+OP_ADD = 2
+OP_MUL = 3
+OP_HINT = 4
+OP_SUM = 5  # Sum of a fused chain of adds, operands in Builder.fused
+OP_PROD = 6  # Product of a fused chain of muls, operands in Builder.fused
+OP_ABSORBED = 7  # Add/mul folded into a later sum/product row, no longer evaluated
+
+# Vectorized operation applied to a whole segment of add/mul (or reduced over sum/product) rows, by opcode
+LAYER_OPS = {OP_ADD: np.add, OP_MUL: np.multiply, OP_SUM: np.add, OP_PROD: np.multiply}
+
+INT64_MIN = np.iinfo(np.int64).min
+INT64_MAX = np.iinfo(np.int64).max
+
+EVAL_SIGNATURE = "int64(int8[:], int32[:], int32[:], int64[:], int64[:], int32[:], int64, int64)"
+CHECK_SIGNATURE = "boolean(int64[:], int32[:], int32[:])"
+
+
+def _eval_rows(op, lhs, rhs, val, fused_ptr, fused_ops, start, stop):
+    """
+    Evaluates the add/mul/sum/product rows in [start, stop) of the graph arrays over int64 values.
+    The operands of a sum/product row are fused_ops[fused_ptr[lhs[i]]:fused_ptr[lhs[i] + 1]].
+    Returns the index of the first row whose result overflows int64, or -1 if there was none.
+    """
+    # Results are range-checked in float64 before the int64 op, since LLVM is free to
+    # optimize away overflow checks written against the wrapped integer result.
+    # The bound is slightly conservative; near-limit rows just fall back to Python.
+    for i in range(start, stop):
+        c = op[i]
+        if c == OP_ADD:
+            a = val[lhs[i]]
+            b = val[rhs[i]]
+            if abs(float(a) + float(b)) >= 9.2e18:
+                return i
+            val[i] = a + b
+        elif c == OP_MUL:
+            a = val[lhs[i]]
+            b = val[rhs[i]]
+            if abs(float(a) * float(b)) >= 9.2e18:
+                return i
+            val[i] = a * b
+        elif c == OP_SUM or c == OP_PROD:
+            k = lhs[i]
+            acc = val[fused_ops[fused_ptr[k]]]
+            for j in range(fused_ptr[k] + 1, fused_ptr[k + 1]):
+                b = val[fused_ops[j]]
+                if c == OP_SUM:
+                    if abs(float(acc) + float(b)) >= 9.2e18:
+                        return i
+                    acc += b
+                else:
+                    if abs(float(acc) * float(b)) >= 9.2e18:
+                        return i
+                    acc *= b
+            val[i] = acc
+    return -1
+
+
+def _check_rows(val, c_lhs, c_rhs):
+    """Checks the equality constraints val[c_lhs[k]] == val[c_rhs[k]], stopping at the first mismatch."""
+    for k in range(len(c_lhs)):
+        if val[c_lhs[k]] != val[c_rhs[k]]:
+            return False
+    return True
+
+
+try:
+    # Kernels compiled ahead of time by aot_compile.py skip Numba's JIT compilation on first use
+    from succinct_kernel import eval_rows as _eval, check_rows as _check
+except ImportError:
+    if njit is not None:
+        _eval = njit(EVAL_SIGNATURE, cache=True, boundscheck=False)(_eval_rows)
+        _check = njit(CHECK_SIGNATURE, cache=True, boundscheck=False)(_check_rows)
+    else:
+        _eval = _check = None
+
 
 class Node:
-    """Represents a node in the computational graph."""
+    """
+    Represents a node in the computational graph.
+    A node is a thin handle: its data lives in row `idx` of the builder's arrays.
+    """
+
+    __slots__ = ("builder", "idx")
 
-    def __init__(self, name: str, value: int = None):
+    def __init__(self, builder: "Builder", idx: int):
         """Creates a new node."""
-        self.value = value
-        self.constraint = lambda: None
-        self.name = name
+        self.builder = builder
+        self.idx = idx
+
+    @property
+    def name(self) -> str:
+        """The node's name, as shown in the debug log."""
+        return self.builder.get_node_name(self.idx)
+
+    @property
+    def value(self) -> int:
+        """The node's value, read from the builder's value array."""
+        return self.builder.val[self.idx]
+
+    @value.setter
+    def value(self, value: int):
+        self.builder.val[self.idx] = value
+        # Values set by hand invalidate what the builder cached about the last fill_nodes call
+        self.builder._last_input_key = None
+        self.builder._val64 = None
 
     def __repr__(self):
         """Print the node's name if object is printed"""
@@ -29,94 +150,658 @@ class Builder:
 
     def __init__(self):
         """Creates a new builder."""
-        self.nodes: [Node] = []
-        self.constraints = []  # List of equality constraints
+        # The graph is stored as a Struct-of-Arrays: row i describes node i.
+        # Rows [0, n) are in use, the arrays are preallocated beyond that and grown by doubling.
+        self.n = 0
+        self.op = np.empty(INITIAL_CAPACITY, dtype=np.int8)  # Opcode of each node
+        self.lhs = np.empty(INITIAL_CAPACITY, dtype=np.int32)  # Left operand row (index into hint_fns for hints)
+        self.rhs = np.empty(INITIAL_CAPACITY, dtype=np.int32)  # Right operand row
+        self.val = np.empty(INITIAL_CAPACITY, dtype=object)  # Value of each node (arbitrary precision ints)
+        self.hint_fns = []  # Hint functions, referenced by hint rows
+        # Operand rows of the sum/product rows created by fuse(), referenced by those rows' lhs.
+        # Kept both as lists for Python and flattened into CSR arrays for the vectorized paths.
+        self.fused: [[int]] = []
+        self.fused_ptr = np.zeros(1, dtype=np.int64)  # Operands of fused[k] are fused_ops[fused_ptr[k]:fused_ptr[k + 1]]
+        self.fused_ops = np.empty(0, dtype=np.int32)
+        # Equality constraints val[constraints[k, 0]] == val[constraints[k, 1]], rows [0, n_constraints) in use
+        self.n_constraints = 0
+        self.constraints = np.empty((INITIAL_CAPACITY, 2), dtype=np.int32)
         self.log: [str] = []
         self.n_constants = 0  # for node naming purposes only
+        self._constants_before: [int] = []  # Constants before each row, kept while DEBUG is on to name nodes in O(1)
+        self._input_idx: [int] = []  # Rows of the input nodes, in insertion order
+        # Memoization of the last fill_nodes call
+        # Sorted (input idx, (type, value)) pairs `val` currently holds the results for.
+        # The type is part of the key, since equal values of different types (1 and 1.0) give different results.
+        self._last_input_key = None
+        self._last_rows = 0  # Number of rows in the graph when `val` was filled
+        # Reverse adjacency for incremental re-solves, built on demand for the first `_children_rows` rows
+        # Both are int64 array.arrays: cheap to index from Python without holding an int object per entry
+        self._children: array = None  # Add/mul rows reading each row, grouped by the row they read
+        self._children_ptr: array = None  # children of row i are _children[_children_ptr[i]:_children_ptr[i + 1]]
+        self._hint_rows: [int] = None  # Rows of all hint nodes
+        self._children_rows = -1
+        # Rows grouped by Kahn layer and opcode for vectorized evaluation, built on demand
+        self._segments = None  # (opcode, rows, lhs rows, rhs rows) per segment, in evaluation order
+        self._segments_rows = -1
+        self._compiled = None  # Straight-line evaluator generated by compile()
+        self._compiled_rows = 0  # Number of rows the evaluator was generated for
+        self._val64 = None  # int64 copy of `val` if the last fill_nodes evaluated it all with the jitted kernel
 
-    def add_log(self, log_message: str):
-        """Adds a log message to the log list and prints it if DEBUG is True."""
-        self.log.append(log_message)
-        if DEBUG:
+    # add_log is picked once, when the class is created, so it costs nothing with DEBUG off.
+    # Call sites are also guarded with `if DEBUG:` so their f-strings are never built.
+    if DEBUG:
+        def add_log(self, log_message: str):
+            """Adds a log message to the log list and prints it."""
+            self.log.append(log_message)
             print(log_message)
+    else:
+        def add_log(self, log_message: str):
+            """Logging is disabled when DEBUG is False."""
 
-    def get_node_name(self, value: int = None) -> str:
+    def get_node_name(self, idx: int) -> str:
         """
-        Generates a unique name for a node.
+        Generates a unique name for the node at row `idx`.
+        Names are only needed for the debug log, so they are computed on demand rather than stored.
         Inspiration: Wanted to make a beautiful debug log without over-engineering.
         Input nodes are set to 'a', 'b', 'c', ...
         Constant nodes are set to their value.
         """
-        # If value is input node
-        if value is None:
-            return chr(ord('a') + len(self.nodes) - self.n_constants)
+        # If node is constant
+        if self.op[idx] == OP_CONST:
+            return str(self.val[idx])
+        # Otherwise the node's letter skips the constants before it
+        if len(self._constants_before) == self.n:
+            n_constants = self._constants_before[idx]
+        elif idx == self.n - 1:
+            n_constants = self.n_constants  # Newest node, the one a log line usually names
         else:
-            # If value is constant
-            self.n_constants += 1
-            return str(value)
+            n_constants = int(np.count_nonzero(self.op[:idx] == OP_CONST))
+        return chr(ord('a') + idx - n_constants)
+
+    def _grow(self):
+        """Doubles the capacity of the graph arrays."""
+        capacity = 2 * len(self.op)
+        for name in ("op", "lhs", "rhs", "val"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def _append(self, op: int, lhs: int, rhs: int, value: int = None) -> Node:
+        """Appends a row to the graph arrays and returns a handle to it."""
+        i = self.n
+        if self.fused and (op == OP_ADD or op == OP_MUL) and OP_ABSORBED in (self.op[lhs], self.op[rhs]):
+            raise ValueError("Nodes folded by fuse() can't be used as operands")
+        if i == len(self.op):
+            self._grow()
+        self.op[i] = op
+        self.lhs[i] = lhs
+        self.rhs[i] = rhs
+        self.val[i] = value
+        self.n = i + 1
+        self._val64 = None  # No longer covers every row
+        if DEBUG:
+            self._constants_before.append(self.n_constants)
+        return Node(self, i)
 
     def init(self) -> Node:
         """Initializes a new node in the graph."""
-        node_name = self.get_node_name()
-        node = Node(node_name)
-        self.nodes.append(node)
-        self.add_log(f"Initialized node: {node}")
+        node = self._append(OP_INPUT, -1, -1)
+        self._input_idx.append(node.idx)
+        if DEBUG:
+            self.add_log(f"Initialized node: {node}")
         return node
 
     def constant(self, value: int) -> Node:
         """Creates a constant node with the given value."""
-        node_name = self.get_node_name(value)
-        node = Node(node_name, value)
-        self.nodes.append(node)
-        self.add_log(f"Created constant node: {node}")
+        node = self._append(OP_CONST, -1, -1, value)
+        self.n_constants += 1
+        if DEBUG:
+            self.add_log(f"Created constant node: {node}")
         return node
 
     def add(self, a: Node, b: Node) -> Node:
         """Adds two nodes and returns the resulting node."""
-        node_name = self.get_node_name()
-        node = Node(node_name)
-        node.constraint = lambda: a.value + b.value
-        self.nodes.append(node)
-        self.add_log(f"Added nodes: {a} + {b} = {node}")
+        node = self._append(OP_ADD, a.idx, b.idx)
+        if DEBUG:
+            self.add_log(f"Added nodes: {a} + {b} = {node}")
         return node
 
     def mul(self, a: Node, b: Node) -> Node:
         """Multiplies two nodes and returns the resulting node."""
-        node_name = self.get_node_name()
-        node = Node(node_name)
-        node.constraint = lambda: a.value * b.value
-        self.nodes.append(node)
-        self.add_log(f"Multiplied nodes: {a} * {b} = {node}")
+        node = self._append(OP_MUL, a.idx, b.idx)
+        if DEBUG:
+            self.add_log(f"Multiplied nodes: {a} * {b} = {node}")
         return node
 
     def assert_equal(self, a: Node, b: Node):
         """Asserts that two nodes are equal."""
-        self.constraints.append(lambda: a.value == b.value)
-        self.add_log(f"Asserted equality: {a} == {b}")
+        if self.fused and OP_ABSORBED in (self.op[a.idx], self.op[b.idx]):
+            raise ValueError("Nodes folded by fuse() can't be constrained")
+        k = self.n_constraints
+        if k == len(self.constraints):
+            constraints = np.empty((2 * k, 2), dtype=np.int32)
+            constraints[:k] = self.constraints
+            self.constraints = constraints
+        self.constraints[k] = a.idx, b.idx
+        self.n_constraints = k + 1
+        if DEBUG:
+            self.add_log(f"Asserted equality: {a} == {b}")
 
     def fill_nodes(self, input_nodes: dict):
         """
         Fills in all the nodes of the graph based on some inputs
         and computes the values of derived/constrained nodes.
         """
+        key = tuple(sorted((node.idx, (type(value), value)) for node, value in input_nodes.items()))
+        last_key = self._last_input_key if self._last_rows == self.n else None
+        if key == last_key:
+            # Same graph and same inputs as the last call, nothing to recompute
+            if DEBUG:
+                self.add_log(f"Inputs unchanged, reusing {self.n} cached node values")
+            return
+        if last_key is not None and [idx for idx, _ in key] == [idx for idx, _ in last_key]:
+            # Only the values of the same inputs changed, so recompute just what lies downstream of them
+            last_values = dict(last_key)
+            self.fill_nodes_incremental(
+                {node: value for node, value in input_nodes.items() if (type(value), value) != last_values[node.idx]})
+            return
+
+        self._last_input_key = None  # Invalidated until this call completes
+        self._val64 = None
         # Fill input nodes
         for node, value in input_nodes.items():
-            node.value = value
-            self.add_log(f"Set input node: {node} = {value}")
+            self.val[node.idx] = value
+            if DEBUG:
+                self.add_log(f"Set input node: {node} = {value}")
+        self._fill_all()
+        self._last_input_key = key
+        self._last_rows = self.n
+
+    def fill_nodes_fast(self, *values: int):
+        """
+        Fills in all the nodes of the graph from the values of its input nodes, given in the order the inputs
+        were created. Skips the per-call bookkeeping of `fill_nodes` (no dict, memoization or incremental
+        re-solve), for evaluating the same graph over and over on fresh inputs.
+        """
+        inputs = self._input_idx
+        if len(values) != len(inputs):
+            raise TypeError(f"fill_nodes_fast() takes {len(inputs)} input values but {len(values)} were given")
+        self._last_input_key = None
+        self._val64 = None
+        if self._compiled is not None and self._compiled_rows == self.n and not DEBUG:
+            # The compiled evaluator takes the input values as its parameters and stores them in `val` itself
+            self._compiled(self.val, *values)
+            return
+        val = self.val
+        for i, value in zip(inputs, values):
+            val[i] = value
+        self._fill_all()
+
+    def fill_nodes_incremental(self, changes: dict):
+        """
+        Changes the values of some input nodes of a graph that `fill_nodes` was already called on
+        and recomputes only the nodes downstream of them.
+        Falls back to a full `fill_nodes` if the graph hasn't been filled since it last changed.
+        :param changes: the input nodes whose value changed, mapped to their new value
+        """
+        last_key = self._last_input_key if self._last_rows == self.n else None
+        if last_key is None:
+            self.fill_nodes(changes)
+            return
+
+        self._last_input_key = None  # Invalidated until this call completes
+        self._val64 = None
+        for node, value in changes.items():
+            self.val[node.idx] = value
+            if DEBUG:
+                self.add_log(f"Set input node: {node} = {value}")
+        # Scattered rows are evaluated one by one in Python, which only beats a full pass while they are a
+        # minority, or a small fraction for graphs large enough for the full pass to be vectorized
+        limit = self.n // 2 if self.n < JIT_MIN_NODES else self.n // 16
+        dirty = self._dirty_rows([node.idx for node in changes], limit)
+        if dirty is None:
+            self._fill_all()
+        else:
+            self._fill_py(dirty)
 
-        # The leftover unfilled nodes are computed based on constraints.
-        for node in self.nodes:
-            if node.value is None:
-                node.value = node.constraint()
-                self.add_log(f"Computed node: {node} = {node.value}")
+        inputs = dict(last_key)
+        inputs.update((node.idx, (type(value), value)) for node, value in changes.items())
+        self._last_input_key = tuple(sorted(inputs.items()))
+        self._last_rows = self.n
+
+    def _fill_all(self):
+        """Computes all the derived nodes from the input values already in `val`."""
+        n = self.n
+        if self._compiled is not None and self._compiled_rows == n:
+            val = self.val
+            self._compiled(val, *[val[i] for i in self._input_idx])
+            if DEBUG:
+                op = self.op[:n]
+                for i in np.flatnonzero((op > OP_CONST) & (op != OP_ABSORBED)).tolist():
+                    self.add_log(f"Computed node: {Node(self, i)} = {val[i]}")
+        elif DEBUG:
+            # The vectorized paths don't log, so DEBUG runs always take the Python loop
+            self._fill_py(range(n))
+        elif _eval is not None and n >= JIT_MIN_NODES:
+            self._fill_py(range(self._fill_int64(), n))
+        elif n >= LAYER_MIN_WIDTH and n >= LAYER_MIN_WIDTH * len(self._segment()):
+            # A graph needs at least one full-width segment to be worth segmenting at all
+            self._fill_layers()
+        else:
+            self._fill_py(range(n))
+
+    def _segment(self):
+        """
+        Groups the derived rows into Kahn layers, then by opcode within each layer.
+        A row only reads rows of earlier layers, so each segment can be evaluated in one vectorized step.
+        Hints may read any earlier node, so a hint's layer comes after the layers of all rows before it.
+        :return: (opcode, rows, lhs rows, rhs rows) per segment, in evaluation order
+        """
+        n = self.n
+        if self._segments_rows == n:
+            return self._segments
+        op, lhs, rhs = self.op[:n].tolist(), self.lhs[:n].tolist(), self.rhs[:n].tolist()
+        layer = [0] * n  # Input and constant rows are layer 0
+        top = 0  # Highest layer so far
+        for i in range(n):
+            c = op[i]
+            if c == OP_ADD or c == OP_MUL:
+                a, b = layer[lhs[i]], layer[rhs[i]]
+                layer[i] = (a if a > b else b) + 1
+            elif c == OP_SUM or c == OP_PROD:
+                layer[i] = max(layer[j] for j in self.fused[lhs[i]]) + 1
+            elif c == OP_HINT:
+                layer[i] = top + 1
+            else:
+                continue
+            if layer[i] > top:
+                top = layer[i]
+
+        op = self.op[:n]
+        rows = np.flatnonzero((op > OP_CONST) & (op != OP_ABSORBED))
+        keys = np.array(layer, dtype=np.int64)[rows] * (OP_PROD + 1) + op[rows]
+        order = np.argsort(keys, kind="stable")
+        rows, keys = rows[order], keys[order]
+        self._segments = []
+        for seg in np.split(rows, np.flatnonzero(np.diff(keys)) + 1):
+            if not len(seg):
+                continue
+            c = int(op[seg[0]])
+            if c == OP_SUM or c == OP_PROD:
+                # Flatten the operands of all rows, to be reduced per row at the given offsets
+                operands = [self.fused[k] for k in self.lhs[seg].tolist()]
+                offsets = np.cumsum([0] + [len(ops) for ops in operands[:-1]])
+                self._segments.append((c, seg, np.concatenate(operands).astype(np.intp), offsets))
+            else:
+                self._segments.append((c, seg, self.lhs[seg], self.rhs[seg]))
+        self._segments_rows = n
+        return self._segments
+
+    def _fill_layers(self):
+        """
+        Computes all the derived nodes one segment of `_segment` at a time, with NumPy ops on the value array.
+        Segments are evaluated over packed int64 values for as long as they fit, then over the object values.
+        """
+        segments = self._segment()
+        val, hint_fns = self.val, self.hint_fns
+        for c, rows, lhs, rhs in segments[self._fill_layers_int64(segments):]:
+            if c == OP_HINT:
+                for i, k in zip(rows.tolist(), lhs.tolist()):
+                    val[i] = hint_fns[k]()
+            elif c == OP_SUM or c == OP_PROD:
+                val[rows] = LAYER_OPS[c].reduceat(val[lhs], rhs)
+            else:
+                val[rows] = LAYER_OPS[c](val[lhs], val[rhs])
+
+    def _fill_layers_int64(self, segments) -> int:
+        """
+        Evaluates `segments` over an int64 copy of the values, using NumPy's SIMD int64 add/multiply loops.
+        Rows computed in int64 are written back to `val` before each hint is called and at the end.
+        :return: the number of segments evaluated,
+        i.e. len(segments) if all results fit in int64, or the first segment that didn't
+        """
+        val, hint_fns = self.val, self.hint_fns
+        val64 = self._load_int64()
+        if val64 is None:
+            return 0
+
+        pending = []  # Rows computed in int64 that aren't written back to `val` yet
+
+        def write_back():
+            if pending:
+                rows = np.concatenate(pending)
+                val[rows] = val64[rows].tolist()
+                pending.clear()
+
+        for s, (c, rows, lhs, rhs) in enumerate(segments):
+            if c == OP_HINT:
+                write_back()
+                fits = True
+                for i, k in zip(rows.tolist(), lhs.tolist()):
+                    value = val[i] = hint_fns[k]()
+                    if isinstance(value, int) and INT64_MIN <= value <= INT64_MAX:
+                        val64[i] = value
+                    else:
+                        fits = False
+                if not fits:
+                    return s + 1
+                continue
+
+            # Bound every result in float64 first, as int64 overflow would wrap silently
+            if c == OP_SUM or c == OP_PROD:
+                operands = val64[lhs]
+                if c == OP_SUM:
+                    bound = np.add.reduceat(np.abs(operands.astype(np.float64)), rhs)
+                else:
+                    bound = np.abs(np.multiply.reduceat(operands.astype(np.float64), rhs))
+                result = LAYER_OPS[c].reduceat(operands, rhs)
+            else:
+                a, b = val64[lhs], val64[rhs]
+                bound = np.abs(LAYER_OPS[c](a.astype(np.float64), b.astype(np.float64)))
+                result = LAYER_OPS[c](a, b, out=a)
+            if (bound >= 9.2e18).any():
+                write_back()
+                return s
+            val64[rows] = result
+            pending.append(rows)
+
+        write_back()
+        self._val64 = val64
+        return len(segments)
+
+    def fuse(self):
+        """
+        Folds chains of adds (or muls) into single sum (or product) rows over all their inputs,
+        e.g. d = (a + b) + c becomes d = a + b + c and the row of a + b is no longer evaluated.
+        A row is only folded into the one row that reads it, and only if no constraint refers to it
+        and no hint comes after it (hints may read any earlier node).
+        Call this once the graph is complete: folded nodes can't be used as operands or in constraints afterwards
+        (add/mul/assert_equal raise ValueError), and their values are no longer kept up to date.
+        """
+        n = self.n
+        op, lhs, rhs = self.op[:n].tolist(), self.lhs[:n].tolist(), self.rhs[:n].tolist()
+        operands = {i: self.fused[lhs[i]] for i in range(n) if op[i] == OP_SUM or op[i] == OP_PROD}
+        for i in range(n):
+            if op[i] == OP_ADD or op[i] == OP_MUL:
+                operands[i] = [lhs[i], rhs[i]]
+        reads = [0] * n
+        for ops in operands.values():
+            for j in ops:
+                reads[j] += 1
+        hint_rows = [i for i in range(n) if op[i] == OP_HINT]
+        first_foldable = hint_rows[-1] + 1 if hint_rows else 0
+        constrained = set(self.constraints[:self.n_constraints].ravel().tolist())
+
+        # Rows are visited in topological order, so a chain folds into its last row step by step
+        for i in range(n):
+            c = op[i]
+            if c == OP_ADD or c == OP_SUM:
+                kind = OP_SUM
+            elif c == OP_MUL or c == OP_PROD:
+                kind = OP_PROD
+            else:
+                continue
+            same = (OP_ADD, OP_SUM) if kind == OP_SUM else (OP_MUL, OP_PROD)
+            folded = []
+            for j in operands[i]:
+                if op[j] in same and reads[j] == 1 and j >= first_foldable and j not in constrained:
+                    folded.extend(operands.pop(j))
+                    op[j] = OP_ABSORBED
+                else:
+                    folded.append(j)
+            if len(folded) > 2:
+                operands[i] = folded
+                op[i] = kind
+
+        self.fused = []
+        for i in sorted(operands):
+            if op[i] == OP_SUM or op[i] == OP_PROD:
+                lhs[i], rhs[i] = len(self.fused), -1
+                self.fused.append(operands[i])
+        absorbed = [i for i in range(n) if op[i] == OP_ABSORBED]
+        self.op[:n], self.lhs[:n], self.rhs[:n] = op, lhs, rhs
+        self.val[absorbed] = None
+        self.fused_ptr = np.cumsum([0] + [len(ops) for ops in self.fused], dtype=np.int64)
+        self.fused_ops = np.array([j for ops in self.fused for j in ops], dtype=np.int32)
+
+        # Everything derived from the old rows is stale
+        self._last_input_key = None
+        self._val64 = None
+        self._compiled = None
+        self._children_rows = self._segments_rows = -1
+        if DEBUG:
+            self.add_log(f"Fused {len(absorbed)} nodes into {len(self.fused)} sum/product nodes")
+
+    def compile(self):
+        """
+        Generates a straight-line Python function that evaluates the graph as it is now, e.g.
+            def _run(val, v0):
+                v1 = v0 * v0
+                v2 = 5
+                ...
+                val[0:4] = (v0, v1, v2, v3)
+        Every node becomes a local variable, so evaluating it is free of list indexing and opcode dispatch.
+        Hints read node values through the builder, so the locals are written back to `val` before each hint.
+        The function is built directly as an AST, so no source code has to be formatted and parsed.
+        fill_nodes uses the function until more nodes are added.
+        :return: the function, called as fn(val, *input values in insertion order)
+        """
+        n = self.n
+        op, lhs, rhs = self.op[:n].tolist(), self.lhs[:n].tolist(), self.rhs[:n].tolist()
+        inputs = self._input_idx
+        local = [ast.Name(f"v{i}", ast.Load()) for i in range(n)]
+        # Rows absorbed by fuse() have no local and are written back as None
+        written = [ast.Constant(None) if op[i] == OP_ABSORBED else local[i] for i in range(n)]
+
+        def write_back(start: int, stop: int) -> ast.Assign:
+            """val[start:stop] = (v{start}, ..., v{stop - 1})"""
+            target = ast.Subscript(ast.Name("val", ast.Load()), ast.Slice(ast.Constant(start), ast.Constant(stop)),
+                                   ast.Store())
+            return ast.Assign([target], ast.Tuple(written[start:stop], ast.Load()))
+
+        # Each hint function is bound to its own global, so calling it skips the hint_fns lookup
+        bound = {f"hint_{k}": hint_func for k, hint_func in enumerate(self.hint_fns)}
+        body = []
+        flushed = 0  # Rows before this one have been written back to `val`
+        for i in range(n):
+            c, l, r = op[i], lhs[i], rhs[i]
+            if c == OP_CONST:
+                if type(self.val[i]) is int:
+                    value = ast.Constant(self.val[i])
+                else:
+                    # Values such as np.int64 or Fraction can't be AST literals, so they are bound as globals too
+                    value = ast.Name(f"const_{i}", ast.Load())
+                    bound[f"const_{i}"] = self.val[i]
+            elif c == OP_ADD:
+                value = ast.BinOp(local[l], ast.Add(), local[r])
+            elif c == OP_MUL:
+                value = ast.BinOp(local[l], ast.Mult(), local[r])
+            elif c == OP_SUM or c == OP_PROD:
+                # v{i} = v{first}, then v{i} += v{j} per operand: one nested BinOp over a long fused chain
+                # would be as deep as the chain is long, and overflow the recursion limit when compiled
+                first, *rest = self.fused[l]
+                body.append(ast.Assign([ast.Name(f"v{i}", ast.Store())], local[first]))
+                for j in rest:
+                    body.append(ast.AugAssign(ast.Name(f"v{i}", ast.Store()), ast.Add() if c == OP_SUM else ast.Mult(),
+                                              local[j]))
+                continue
+            elif c == OP_HINT:
+                if flushed < i:
+                    body.append(write_back(flushed, i))
+                flushed = i
+                value = ast.Call(ast.Name(f"hint_{l}", ast.Load()), [], [])
+            else:
+                continue
+            body.append(ast.Assign([ast.Name(f"v{i}", ast.Store())], value))
+        if flushed < n:
+            body.append(write_back(flushed, n))
+
+        # Only the function's signature comes from a (tiny) parsed template
+        module = ast.parse("def _run(val):\n    pass")
+        function = module.body[0]
+        function.args.args += [ast.arg(f"v{i}") for i in inputs]
+        function.body = body or function.body
+        ast.fix_missing_locations(module)
+
+        namespace = {}
+        exec(compile(module, "<graph>", "exec"), bound, namespace)
+        self._compiled = namespace["_run"]
+        self._compiled_rows = n
+        return self._compiled
+
+    def _dirty_rows(self, changed: [int], limit: int):
+        """
+        Returns the sorted rows that have to be recomputed after the inputs at rows `changed` changed value,
+        or None if there are more than `limit` of them.
+        Hints are opaque functions that may read any earlier node, so every hint after
+        the first changed row is treated as dirty along with everything downstream of it.
+        """
+        n = self.n
+        if self._children_rows != n:
+            # The operand rows already are the graph's edges; invert them once into a CSR adjacency
+            # where the rows reading row i are children[children_ptr[i]:children_ptr[i + 1]]
+            op = self.op[:n]
+            rows = np.flatnonzero((op == OP_ADD) | (op == OP_MUL))
+            lhs, rhs = self.lhs[rows], self.rhs[rows]
+            distinct = lhs != rhs
+            # Sum/product rows read each of their fused operands
+            fused_rows = np.flatnonzero((op == OP_SUM) | (op == OP_PROD))
+            k = self.lhs[fused_rows]
+            counts = self.fused_ptr[k + 1] - self.fused_ptr[k]
+            fused_operands = self.fused_ops[np.concatenate([np.arange(self.fused_ptr[j], self.fused_ptr[j + 1])
+                                                            for j in k.tolist()] + [np.empty(0, np.int64)])]
+            parents = np.concatenate([lhs, rhs[distinct], fused_operands])
+            order = np.argsort(parents, kind="stable")
+            ptr = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(parents, minlength=n), out=ptr[1:])
+            children = np.concatenate([rows, rows[distinct], np.repeat(fused_rows, counts)])[order].astype(np.int64)
+            self._children = array("q", children.tobytes())
+            self._children_ptr = array("q", ptr.tobytes())
+            self._hint_rows = np.flatnonzero(op == OP_HINT).tolist()
+            self._children_rows = n
+        children, ptr = self._children, self._children_ptr
+
+        hints = self._hint_rows[bisect.bisect_right(self._hint_rows, min(changed, default=n)):]
+        if len(hints) > limit:
+            return None
+        dirty = set(hints)
+        stack = [*changed, *hints]
+        while stack:
+            i = stack.pop()
+            for child in children[ptr[i]:ptr[i + 1]]:
+                if child not in dirty:
+                    dirty.add(child)
+                    stack.append(child)
+            if len(dirty) > limit:
+                return None
+        return sorted(dirty)
+
+    def _fill_py(self, rows):
+        """Computes the derived nodes at the given ascending rows in pure Python (arbitrary precision)."""
+        # Derived nodes are computed in insertion order, which is already topological.
+        # Rows are read from list copies of the arrays, since indexing a list is cheaper than an array.
+        n = self.n
+        op, lhs, rhs = self.op[:n].tolist(), self.lhs[:n].tolist(), self.rhs[:n].tolist()
+        val, hint_fns, fused = self.val, self.hint_fns, self.fused
+        debug = DEBUG
+        for i in rows:
+            c = op[i]
+            if c == OP_ADD:
+                val[i] = val[lhs[i]] + val[rhs[i]]
+            elif c == OP_MUL:
+                val[i] = val[lhs[i]] * val[rhs[i]]
+            elif c == OP_HINT:
+                val[i] = hint_fns[lhs[i]]()
+            elif c == OP_SUM:
+                val[i] = sum([val[j] for j in fused[lhs[i]]])
+            elif c == OP_PROD:
+                val[i] = math.prod([val[j] for j in fused[lhs[i]]])
+            else:
+                continue  # Input and constant nodes already hold their values, absorbed nodes are skipped
+            if debug:
+                self.add_log(f"Computed node: {Node(self, i)} = {val[i]}")
+
+    def _load_int64(self):
+        """
+        Returns an int64 array with the input and constant values loaded into their rows,
+        or None if one of them is missing, not an integer or too large.
+        NumPy would silently truncate other numbers when packing them, so they are left to the Python paths.
+        """
+        n = self.n
+        val64 = np.zeros(n, dtype=np.int64)
+        known = np.flatnonzero(self.op[:n] <= OP_CONST)
+        values = self.val[known]
+        if not all(isinstance(value, (int, np.integer)) for value in values.tolist()):
+            return None
+        try:
+            val64[known] = values
+        except (TypeError, OverflowError):
+            return None
+        return val64
+
+    def _fill_int64(self) -> int:
+        """
+        Computes the derived nodes with the jitted int64 kernel.
+        Hint functions can't be jitted, so the kernel runs on the rows between hints
+        and each hint is called in Python with the values before it synced back to `val`.
+        :return: the row the Python loop has to resume from,
+        i.e. self.n if the whole graph fit in int64, or the first row that didn't
+        """
+        n = self.n
+        op, lhs, rhs = self.op[:n], self.lhs[:n], self.rhs[:n]
+        val, hint_fns = self.val, self.hint_fns
+
+        val64 = self._load_int64()
+        if val64 is None:
+            return 0
+
+        def write_back(start: int, stop: int):
+            val[start:stop] = val64[start:stop].tolist()
+            if self.fused:
+                # Rows absorbed by fuse() aren't evaluated and keep None rather than their zero in val64
+                val[start + np.flatnonzero(op[start:stop] == OP_ABSORBED)] = None
+
+        start = 0
+        for stop in [*np.flatnonzero(op == OP_HINT).tolist(), n]:
+            overflow = _eval(op, lhs, rhs, val64, self.fused_ptr, self.fused_ops, start, stop)
+            if overflow != -1:
+                write_back(start, overflow)
+                return overflow
+            write_back(start, stop)
+            if stop == n:
+                break
+
+            value = val[stop] = hint_fns[lhs[stop]]()
+            if not isinstance(value, int) or not INT64_MIN <= value <= INT64_MAX:
+                return stop + 1
+            val64[stop] = value
+            start = stop + 1
+        self._val64 = val64
+        return n
 
     def check_constraints(self) -> bool:
         """
         Given a graph that has `fill_nodes` already called on it
         checks that all the constraints hold.
         """
-        satisfied = all(constraint() for constraint in self.constraints)
-        self.add_log(f"Constraints satisfied: {satisfied}")
+        constraints = self.constraints[:self.n_constraints]
+        # Compare packed int64 values when the last fill_nodes left them behind
+        val = self.val[:self.n] if self._val64 is None else self._val64
+        if _check is not None and self._val64 is not None:
+            satisfied = _check(val, constraints[:, 0], constraints[:, 1])
+        else:
+            # Gather both sides of a block of constraints and compare them in one vectorized op,
+            # stopping at the first block with a mismatch
+            satisfied = True
+            for start in range(0, len(constraints), CHECK_BLOCK_SIZE):
+                block = constraints[start:start + CHECK_BLOCK_SIZE]
+                if (val.take(block[:, 0]) != val.take(block[:, 1])).any():
+                    satisfied = False
+                    break
+        if DEBUG:
+            self.add_log(f"Constraints satisfied: {satisfied}")
         return satisfied
 
     def hint(self, hint_func) -> Node:
@@ -126,11 +811,11 @@ class Builder:
         :param hint_func: arbitrary function
         :return: hint node
         """
-        node_name = self.get_node_name()
-        node = Node(node_name)
-        node.constraint = lambda: hint_func()
-        self.nodes.append(node)
-        self.add_log(f"Created hint node: {node}")
+        # The hint row points at hint_func in the hint_fns table, which is called directly when evaluating
+        node = self._append(OP_HINT, len(self.hint_fns), -1)
+        self.hint_fns.append(hint_func)
+        if DEBUG:
+            self.add_log(f"Created hint node: {node}")
         return node
 
 
@@ -209,6 +894,257 @@ def test_example_4(a_input: int, b_input: int):
     print(f"Example 4 Passed!")
 
 
+def test_fused(a_input: int):
+    """
+    Test case for f(a) = a^2 + a + 5 with the add chain fused into a single sum.
+    c = b + 5 is only read by d = c + a, so d becomes b + 5 + a and c is no longer evaluated.
+    """
+    print(f"\nTesting Fused Graph: f(a) = a^2 + a + 5, a = {a_input}")
+    builder = Builder()
+    a = builder.init()
+    b = builder.mul(a, a)  # b = a^2
+    five = builder.constant(5)
+    c = builder.add(b, five)  # c = a^2 + 5
+    d = builder.add(c, a)  # d = a^2 + a + 5
+    builder.fuse()
+    # c no longer has a value of its own, so it can't be used in new nodes or constraints
+    for use in (lambda: builder.add(c, a), lambda: builder.assert_equal(c, b)):
+        try:
+            use()
+            assert False, "folded node was accepted"
+        except ValueError:
+            print("Caught ValueError for using a folded node")
+
+    builder.fill_nodes({a: a_input})
+    assert builder.check_constraints()
+    assert d.value == a_input ** 2 + a_input + 5
+    print(f"Fused Graph Passed!")
+
+
+def test_compiled(a_inputs: [int]):
+    """
+    Test case for evaluating f(a) = (a+1) / 8 repeatedly with a compiled graph.
+    Every a+1 is assumed to be divisible by 8.
+    """
+    print(f"\nTesting Compiled Graph: f(a) = (a+1) / 8, a in {a_inputs}")
+    builder = Builder()
+    a = builder.init()
+    b = builder.add(a, builder.constant(1))  # b = a + 1
+    c = builder.hint(lambda: b.value // 8)  # Hint computed value of c
+    d = builder.mul(c, builder.constant(np.int64(8)))  # d = c * 8, with a constant that isn't an AST literal
+    builder.assert_equal(b, d)
+    builder.compile()
+    for a_input in a_inputs:
+        builder.fill_nodes({a: a_input})
+        assert builder.check_constraints()
+        assert c.value == (a_input + 1) // 8
+    for a_input in a_inputs:
+        builder.fill_nodes_fast(a_input)  # Inputs bound by position
+        assert builder.check_constraints()
+        assert c.value == (a_input + 1) // 8
+    try:
+        builder.fill_nodes_fast()
+    except TypeError:
+        print("Caught TypeError for a missing input value")
+    print(f"Compiled Graph Passed!")
+
+
+def test_memoized(a_input: int):
+    """
+    Test case for f(a) = a^2 + a + 5 filled twice with the same input, with a^2 hinted.
+    The second fill_nodes call keeps the values of the first without calling the hint again.
+    """
+    print(f"\nTesting Memoized Graph: f(a) = a^2 + a + 5, a = {a_input}")
+    builder = Builder()
+    a = builder.init()
+    calls = []
+    b = builder.hint(lambda: calls.append(a.value) or a.value ** 2)  # b = a^2, recording each call
+    c = builder.add(b, builder.constant(5))  # c = a^2 + 5
+    d = builder.add(c, a)  # d = a^2 + a + 5
+
+    builder.fill_nodes({a: a_input})
+    builder.fill_nodes({a: a_input})
+    assert calls == [a_input]
+    assert d.value == a_input ** 2 + a_input + 5
+    # An equal value of another type is a different input
+    builder.fill_nodes({a: float(a_input)})
+    assert calls == [a_input, a_input]
+    assert type(d.value) is float and d.value == a_input ** 2 + a_input + 5
+    print(f"Memoized Graph Passed!")
+
+def test_incremental(a_input: int, b_input: int, b_new: int):
+    """
+    Test case for f(a, b) = a^2 + b, re-solved incrementally after b changes.
+    Only d = c + b has to be recomputed when b changes.
+    """
+    print(f"\nTesting Incremental Re-solve: f(a, b) = a^2 + b, a = {a_input}, b = {b_input} -> {b_new}")
+    builder = Builder()
+    a = builder.init()
+    b = builder.init()
+    c = builder.mul(a, a)  # c = a^2
+    d = builder.add(c, b)  # d = a^2 + b
+    e = builder.hint(lambda: d.value)  # Hint copy of d
+    builder.assert_equal(d, e)
+
+    builder.fill_nodes({a: a_input, b: b_input})
+    assert builder.check_constraints()
+    builder.fill_nodes_incremental({b: b_new})
+    assert builder.check_constraints()
+    assert d.value == a_input ** 2 + b_new
+    print(f"Incremental Re-solve Passed!")
+
+
+def debug_off(test):
+    """Runs the decorated test with DEBUG off, so fill_nodes takes the fast paths that the debug log bypasses."""
+    def run(*args):
+        global DEBUG
+        debug, DEBUG = DEBUG, False
+        try:
+            return test(*args)
+        finally:
+            DEBUG = debug
+    return run
+
+
+def wide_graph(width: int, n_layers: int, overflow: bool):
+    """
+    Builds a wide graph of 4 inputs and `n_layers` layers of `width` nodes, each node adding two nodes of the
+    layer before or multiplying one by 3, with a hint copy of each layer's first node constrained to equal it.
+    With `overflow`, a chain of squarings of the last input follows. The graph ends with an add chain over
+    the first nodes of the last layer, for fuse() to fold into its last node.
+    :return: the builder, the input nodes, the add chain's nodes, and a function computing the expected value
+    of every derived node in plain Python, as a list of (node, value) pairs, from the input values
+    """
+    builder = Builder()
+    inputs = [builder.init() for _ in range(4)]
+    three = builder.constant(3)
+    steps = []  # (node, fn, operand nodes) of each derived node, in insertion order
+    layer = inputs + [three]
+    for _ in range(n_layers):
+        # Each layer only reads the one before it, so values grow at most 3x per layer
+        next_layer = []
+        for k in range(width):
+            a, b = layer[k % len(layer)], layer[(3 * k + 1) % len(layer)]
+            if k % 2:
+                steps.append((builder.add(a, b), lambda x, y: x + y, (a, b)))
+            else:
+                steps.append((builder.mul(a, three), lambda x, y: x * y, (a, three)))
+            next_layer.append(steps[-1][0])
+        copy = builder.hint(lambda node=next_layer[0]: node.value)  # Hint copy
+        steps.append((copy, lambda x: x, (next_layer[0],)))
+        builder.assert_equal(copy, next_layer[0])
+        layer = next_layer + [copy]
+    if overflow:
+        square = inputs[3]
+        for _ in range(8):
+            steps.append((builder.mul(square, square), lambda x, y: x * y, (square, square)))
+            square = steps[-1][0]  # Past int64 from the 3rd squaring of 1000
+        copy = builder.hint(lambda node=square: node.value)
+        steps.append((copy, lambda x: x, (square,)))
+        builder.assert_equal(copy, square)
+    chain = [layer[0]]
+    for node in layer[1:8]:
+        steps.append((builder.add(chain[-1], node), lambda x, y: x + y, (chain[-1], node)))
+        chain.append(steps[-1][0])
+
+    def expected(values: [int]) -> list:
+        value = {node.idx: v for node, v in zip(inputs, values)}
+        value[three.idx] = 3
+        for node, fn, operands in steps:
+            value[node.idx] = fn(*[value[operand.idx] for operand in operands])
+        return [(node, value[node.idx]) for node, _, _ in steps]
+
+    return builder, inputs, chain[1:], expected
+
+
+def check_wide_graph(overflow: bool, width: int, n_layers: int):
+    """Fills a wide graph through the public API and checks every value against plain Python, fused or not."""
+    builder, inputs, chain, expected = wide_graph(width, n_layers, overflow)
+    folded = set()
+    for fused in (False, True):
+        if fused:
+            builder.fuse()
+            folded = {node.idx for node in chain[:-1]}  # Folded nodes keep no value
+        for values in ([3, -7, 11, 1000], [3, -7, 0.5, 1000]):  # Integers, then a float that int64 can't hold
+            builder.fill_nodes(dict(zip(inputs, values)))
+            assert builder.check_constraints()
+            for node, value in expected(values):
+                assert node.value == (None if node.idx in folded else value)
+
+
+@debug_off
+def test_jitted(overflow: bool):
+    """
+    Test case for a wide graph of JIT_MIN_NODES+ nodes with hints, which fill_nodes evaluates with the jitted
+    int64 kernel (or the layered NumPy path without Numba).
+    With `overflow`, some values grow past int64 and have to be recomputed in Python.
+    """
+    print(f"\nTesting Jitted Graph: overflow = {overflow}")
+    check_wide_graph(overflow, LAYER_MIN_WIDTH, JIT_MIN_NODES // LAYER_MIN_WIDTH)
+    print(f"Jitted Graph Passed!")
+
+
+@debug_off
+def test_layered(overflow: bool):
+    """
+    Test case for a graph wide enough for fill_nodes to evaluate it one layer at a time with NumPy,
+    first over packed int64 values and then over the object values once they outgrow int64.
+    """
+    global JIT_MIN_NODES
+    print(f"\nTesting Layered Graph: overflow = {overflow}")
+    jit_min_nodes, JIT_MIN_NODES = JIT_MIN_NODES, math.inf  # Keep the graph off the jitted kernel
+    try:
+        check_wide_graph(overflow, 8 * LAYER_MIN_WIDTH, 6)
+    finally:
+        JIT_MIN_NODES = jit_min_nodes
+    print(f"Layered Graph Passed!")
+
+
+@debug_off
+def test_int64_constraints():
+    """Test case for checking constraints over the int64 values the jitted kernel leaves behind."""
+    print(f"\nTesting Int64 Constraints")
+    for add_row in (False, True):
+        builder, inputs, _, _ = wide_graph(LAYER_MIN_WIDTH, JIT_MIN_NODES // LAYER_MIN_WIDTH, False)
+        builder.fill_nodes(dict(zip(inputs, [3, -7, 11, 1000])))
+        assert builder.check_constraints()
+        if add_row:
+            # Rows added after the fill aren't covered by the int64 values
+            builder.assert_equal(builder.constant(3), inputs[0])
+            assert builder.check_constraints()
+        builder.assert_equal(inputs[0], inputs[1])
+        assert not builder.check_constraints()
+    print(f"Int64 Constraints Passed!")
+
+
+@debug_off
+def test_empty_graph():
+    """Test case for filling and re-solving a graph without nodes."""
+    print(f"\nTesting Empty Graph")
+    builder = Builder()
+    builder.fill_nodes({})
+    builder.fill_nodes_incremental({})
+    assert builder.check_constraints()
+    print(f"Empty Graph Passed!")
+
+
+@debug_off
+def test_fused_chain(length: int):
+    """Test case for f(a) = (length + 1) * a as a chain of adds, fused into one sum and compiled."""
+    print(f"\nTesting Fused Chain: f(a) = {length + 1} * a")
+    builder = Builder()
+    a = builder.init()
+    b = a
+    for _ in range(length):
+        b = builder.add(b, a)  # b = b + a
+    builder.fuse()
+    builder.compile()
+
+    builder.fill_nodes({a: 3})
+    assert builder.check_constraints()
+    assert b.value == (length + 1) * 3
+    print(f"Fused Chain Passed!")
+
 def test_edge_cases():
     """Test cases for edge cases"""
     print("\nTesting Edge Cases")
@@ -268,5 +1204,16 @@ if __name__ == "__main__":
     test_example_2(7)
     test_example_3(2)
     test_example_4(6, 3)
+    test_fused(3)
+    test_compiled([7, 15, -9, 1000000 - 1])
+    test_memoized(3)
+    test_incremental(3, 4, 10)
+    test_jitted(False)
+    test_jitted(True)
+    test_layered(False)
+    test_layered(True)
+    test_int64_constraints()
+    test_empty_graph()
+    test_fused_chain(5000)
     test_edge_cases()
     print("\nAll tests passed!")